@@ -1,8 +1,10 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from io import BytesIO
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
+from contextlib import asynccontextmanager
 
 # backend functions
 from backend import (
@@ -10,10 +12,26 @@ from backend import (
     preprocess_with_llm,
     generate_audio_bytes,
     audio_stream_generator,
+    get_cached_audio,
+    cache_audio,
     SUPPORTED_LANGUAGES
 )
+from prefetch import Prefetcher, load_prefetch_config
 
-app = FastAPI(title="Article to Audio API")
+
+# background prefetcher for rss/sitemap feeds, only runs if PREFETCH_FEEDS is set
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    config = load_prefetch_config()
+    app.state.prefetcher = Prefetcher(**config) if config["feeds"] else None
+    if app.state.prefetcher:
+        app.state.prefetcher.start()
+    yield
+    if app.state.prefetcher:
+        app.state.prefetcher.stop()
+
+
+app = FastAPI(title="Article to Audio API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -49,6 +67,20 @@ async def generate_audio(request: GenerateRequest):
         if request.type not in ["full", "summary"]:
             raise HTTPException(400, "Type must be 'full' or 'summary'")
         
+        # only web pages, file:// or other urls must never reach the cache or the extractors
+        if request.url and not request.url.startswith(("http://", "https://")):
+            raise HTTPException(400, "URL must start with http:// or https://")
+        
+        # if this url was already generated (or prefetched) send it from cache
+        if request.url:
+            cached = get_cached_audio(request.url, request.language, request.type)
+            if cached is not None:
+                return StreamingResponse(
+                    audio_stream_generator(BytesIO(cached)),
+                    media_type="audio/mpeg",
+                    headers={"Content-Disposition": "inline; filename=article.mp3", "X-Cache": "HIT"}
+                )
+        
         # Get content from the url 
         content = extract_article_content(request.url) if request.url else request.text
         
@@ -62,11 +94,15 @@ async def generate_audio(request: GenerateRequest):
         # Generate audio buffer
         audio_buffer = generate_audio_bytes(text_for_audio, request.language)
         
+        # untranslated fallback audio (llm was down) is sent but not cached
+        if request.url and not processed.get("llm_failed"):
+            cache_audio(request.url, request.language, request.type, audio_buffer.getvalue())
+        
         # Return streaming response for the buffer audio
         return StreamingResponse(
             audio_stream_generator(audio_buffer),
             media_type="audio/mpeg",
-            headers={"Content-Disposition": "inline; filename=article.mp3"}
+            headers={"Content-Disposition": "inline; filename=article.mp3", "X-Cache": "MISS"}
         )
     
     except HTTPException:
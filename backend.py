@@ -1,5 +1,9 @@
 from io import BytesIO # in-memory binary stream : it sotres the audio in the memory not disk (laptop band, audio delete)
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional, AsyncIterator
 import requests
 
@@ -23,14 +27,19 @@ SUPPORTED_LANGUAGES = {
 
 
 # this fn extrac the content of article from url we try 3 methrod for this 
-def extract_article_content(url):
+# if html is given (raw page bytes the prefetcher already downloaded) we parse that instead of downloading again,
+# the extractors detect the charset of the page themselves
+def extract_article_content(url, html: Optional[bytes] = None):
     
     print(f"Extracting content from: {url}")
     
     # first we try with newspaper3k
     try:
         article = Article(url)
-        article.download()
+        if html:
+            article.download(input_html=html)
+        else:
+            article.download()
         article.parse()
         content = article.text
         
@@ -42,7 +51,7 @@ def extract_article_content(url):
     
     # if upar wala fails then we tru- trafilatura
     try:
-        downloaded = trafilatura.fetch_url(url)
+        downloaded = html if html else trafilatura.fetch_url(url)
         content = trafilatura.extract(downloaded, include_comments=False)
         
         if content and len(content) >= 300:
@@ -53,12 +62,16 @@ def extract_article_content(url):
     
     # if above again fails the we try the r-lxml
     try:
-        response = requests.get(url, timeout=10, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
-        response.raise_for_status()
+        if html:
+            page = html
+        else:
+            response = requests.get(url, timeout=10, headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            })
+            response.raise_for_status()
+            page = response.content
         
-        doc = Document(response.content)
+        doc = Document(page)
         content = doc.summary()
         
         # use beautiful soup to remove html tags
@@ -151,9 +164,11 @@ JSON Response in {language_name}:"""
     except Exception as e:
         print(f"llm fail while procesing: {e}")
         # Fallback: if llm fails return original text without translation
+        # llm_failed tells callers not to cache this, it is not translated
         return {
             "cleaned_text": text,
-            "summary": text[:500] + "..." if len(text) > 500 else text # for summary first 500 charaters of original extraction
+            "summary": text[:500] + "..." if len(text) > 500 else text, # for summary first 500 charaters of original extraction
+            "llm_failed": True
         }
 
 
@@ -183,6 +198,66 @@ def generate_audio_bytes(text, language) -> BytesIO:
 
 
 
+# in memory audio cache : (url, language, type) -> mp3 bytes, so same article is not processed again and again
+# filled by /generate and by the feed prefetcher (prefetch.py)
+# limited by total size in bytes (least recently used is dropped first) and entries from /generate expire after a ttl,
+# entries stored by the prefetcher do not expire because the prefetcher itself refreshes them when the article changes
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(200 * 1024 * 1024))) # 200 MB
+AUDIO_CACHE_TTL = float(os.getenv("AUDIO_CACHE_TTL", str(6 * 60 * 60))) # 6 hours
+_audio_cache = OrderedDict() # key -> (mp3 bytes, expires at or None)
+_audio_cache_bytes = 0
+_audio_cache_lock = threading.Lock() # prefetcher runs in its own thread
+
+
+def _drop_cached_audio(key):
+    global _audio_cache_bytes
+    audio_bytes, _ = _audio_cache.pop(key)
+    _audio_cache_bytes -= len(audio_bytes)
+
+
+def get_cached_audio(url, language, output_type) -> Optional[bytes]:
+    with _audio_cache_lock:
+        key = (url, language, output_type)
+        if key not in _audio_cache:
+            return None
+        audio_bytes, expires_at = _audio_cache[key]
+        if expires_at is not None and time.monotonic() > expires_at:
+            _drop_cached_audio(key)
+            return None
+        _audio_cache.move_to_end(key) # recently used
+        return audio_bytes
+
+
+# same as get_cached_audio but does not mark the entry as recently used (prefetcher checks with this)
+def has_cached_audio(url, language, output_type) -> bool:
+    with _audio_cache_lock:
+        entry = _audio_cache.get((url, language, output_type))
+        return entry is not None and (entry[1] is None or time.monotonic() <= entry[1])
+
+
+def cache_audio(url, language, output_type, audio_bytes: bytes, expires: bool = True):
+    global _audio_cache_bytes
+    if len(audio_bytes) > AUDIO_CACHE_MAX_BYTES:
+        return # bigger than whole cache, dont keep it
+    with _audio_cache_lock:
+        key = (url, language, output_type)
+        if key in _audio_cache:
+            _drop_cached_audio(key)
+        expires_at = time.monotonic() + AUDIO_CACHE_TTL if expires else None
+        _audio_cache[key] = (audio_bytes, expires_at)
+        _audio_cache_bytes += len(audio_bytes)
+        while _audio_cache_bytes > AUDIO_CACHE_MAX_BYTES:
+            _drop_cached_audio(next(iter(_audio_cache))) # remove least recently used
+
+
+def clear_audio_cache():
+    global _audio_cache_bytes
+    with _audio_cache_lock:
+        _audio_cache.clear()
+        _audio_cache_bytes = 0
+
+
+
 # takes audio stored in memory and send it out in small pieces (chunks) — instead of sending the whole file at once; listen while it is still loading
 
 async def audio_stream_generator(audio_buffer: BytesIO, chunk_size: int = 8192) -> AsyncIterator[bytes]:
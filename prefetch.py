@@ -0,0 +1,426 @@
+# background prefetcher : polls rss / atom / sitemap feeds of known publishers and runs the
+# extraction -> llm -> tts pipeline ahead of time so that /generate for those urls is a cache hit
+import hashlib
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urljoin, urlparse
+from urllib.request import url2pathname
+
+import requests
+
+from backend import (
+    extract_article_content,
+    preprocess_with_llm,
+    generate_audio_bytes,
+    cache_audio,
+    has_cached_audio,
+    AUDIO_CACHE_MAX_BYTES,
+    SUPPORTED_LANGUAGES
+)
+
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+
+# read prefetch settings from env, PREFETCH_FEEDS is comma seperated list of feed urls or local file paths
+def load_prefetch_config():
+
+    def split_env(name, default=""):
+        return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+    return {
+        "feeds": split_env("PREFETCH_FEEDS"),
+        "languages": split_env("PREFETCH_LANGUAGES", "en"),
+        "types": split_env("PREFETCH_TYPES", "full,summary"),
+        "interval": float(os.getenv("PREFETCH_INTERVAL", "300")), # seconds between polls
+        "max_llm_calls": int(os.getenv("PREFETCH_MAX_LLM_CALLS", "10")), # llm budget per poll
+        "max_seconds": float(os.getenv("PREFETCH_MAX_SECONDS", "120")), # time budget per poll
+        "max_revalidations": int(os.getenv("PREFETCH_MAX_REVALIDATIONS", "20")), # articles without version checked per poll
+        "max_rewarms": int(os.getenv("PREFETCH_MAX_REWARMS", "5")), # evicted articles made again per poll
+        "max_articles": int(os.getenv("PREFETCH_MAX_ARTICLES", "50")), # newest articles taken from each feed
+    }
+
+
+# feeds and articles can be http urls, file:// urls or plain paths (for testing with a local folder)
+def to_url(location):
+    if urlparse(location).scheme in ("http", "https", "file"):
+        return location
+    return Path(location).resolve().as_uri()
+
+
+def is_local(url):
+    return urlparse(url).scheme == "file"
+
+
+# conditional fetch : returns (body, validators), body is None when nothing changed since last time
+# http uses ETag / Last-Modified, local files use the modification time
+def conditional_fetch(url, validators: Optional[dict] = None):
+    validators = validators or {}
+
+    if is_local(url):
+        path = url2pathname(urlparse(url).path)
+        mtime = os.path.getmtime(path)
+        if validators.get("mtime") == mtime:
+            return None, validators
+        with open(path, "rb") as f:
+            return f.read(), {"mtime": mtime}
+
+    headers = {"User-Agent": USER_AGENT}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = requests.get(url, timeout=10, headers=headers)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+
+    return response.content, {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def _tag(element):
+    return element.tag.rsplit("}", 1)[-1] # drop xml namespace
+
+
+def _child_text(element, name):
+    for child in element:
+        if _tag(child) == name and child.text:
+            return child.text.strip()
+    return None
+
+
+# parse rss 2.0, atom, sitemap and sitemap index
+# returns (articles, child_feeds) where articles is list of (url, version), version is pubDate / updated / lastmod if present
+# only a local feed may point to local files, links of a remote feed must be http(s) so a publisher cant read server files
+def parse_feed(body, feed_url):
+    root = ET.fromstring(body)
+    articles, child_feeds = [], []
+    allowed_schemes = ("http", "https", "file") if is_local(feed_url) else ("http", "https")
+
+    def resolve(link):
+        url = urljoin(feed_url, link)
+        return url if urlparse(url).scheme in allowed_schemes else None
+
+    for element in root.iter():
+        name = _tag(element)
+
+        if name == "item": # rss
+            link = _child_text(element, "link")
+            if not link:
+                # guid is only a url when isPermaLink is not false, otherwise it is just an id like urn:uuid:123
+                for child in element:
+                    if _tag(child) == "guid" and child.text and child.get("isPermaLink", "true") != "false":
+                        guid = child.text.strip()
+                        if urlparse(guid).scheme in allowed_schemes:
+                            link = guid
+            version = _child_text(element, "pubDate") or _child_text(element, "updated")
+            url = resolve(link) if link else None
+            if url:
+                articles.append((url, version))
+
+        elif name == "entry": # atom
+            link = None
+            for child in element:
+                if _tag(child) == "link" and child.get("rel", "alternate") == "alternate":
+                    link = child.get("href")
+                    break
+            version = _child_text(element, "updated") or _child_text(element, "published")
+            url = resolve(link) if link else None
+            if url:
+                articles.append((url, version))
+
+        elif name == "url": # sitemap
+            loc = _child_text(element, "loc")
+            url = resolve(loc) if loc else None
+            if url:
+                articles.append((url, _child_text(element, "lastmod")))
+
+        elif name == "sitemap": # sitemap index, points to more sitemaps
+            loc = _child_text(element, "loc")
+            url = resolve(loc) if loc else None
+            if url:
+                child_feeds.append(url)
+
+    return articles, child_feeds
+
+
+# article version as timestamp, rss uses rfc 822 dates (pubDate), atom and sitemaps use iso 8601
+def parse_version_date(version) -> Optional[float]:
+    if not version:
+        return None
+    try:
+        parsed = parsedate_to_datetime(version)
+    except (TypeError, ValueError):
+        try:
+            parsed = datetime.fromisoformat(version.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+# sort (url, version) pairs newest first, articles without a date keep their feed order after the dated ones
+def newest_first(articles):
+    dates = {url: parse_version_date(version) for url, version in articles}
+    return sorted(articles, key=lambda article: (dates[article[0]] is None, -(dates[article[0]] or 0)))
+
+
+class Prefetcher:
+
+    def __init__(self, feeds, languages=("en",), types=("full", "summary"), interval=300.0,
+                 max_llm_calls=10, max_seconds=120.0, max_revalidations=20, max_rewarms=5,
+                 max_articles=50):
+        for language in languages:
+            if language not in SUPPORTED_LANGUAGES:
+                raise ValueError(f"Language must be one of {list(SUPPORTED_LANGUAGES.keys())}")
+        for output_type in types:
+            if output_type not in ["full", "summary"]:
+                raise ValueError("Type must be 'full' or 'summary'")
+        if max_llm_calls < len(languages):
+            # an article needs one llm call per language, with a smaller budget nothing would ever be prefetched
+            raise ValueError(f"max_llm_calls must be at least the number of languages ({len(languages)})")
+
+        self.feeds = [to_url(feed) for feed in feeds]
+        self.languages = list(languages)
+        self.types = list(types)
+        self.interval = interval
+        self.max_llm_calls = max_llm_calls
+        self.max_seconds = max_seconds
+        self.max_revalidations = max_revalidations
+        self.max_rewarms = max_rewarms
+        self.max_articles = max_articles
+
+        self.feed_validators = {} # feed url -> etag / last-modified / mtime
+        self.feed_articles = {} # feed url -> {article url -> version} from last time the feed changed
+        self.child_feeds = {} # sitemap index url -> its sitemaps
+        self.articles = {} # article url -> {"version", "validators", "hash", "processed", "audio_bytes"} of last processed state
+        self.failures = {} # article url -> {"count", "retry_at"}, failed articles wait before next try
+        self.llm_calls = 0 # llm calls made in current poll
+        self._revalidate_from = 0 # articles without version are checked in turns, this is where next poll starts
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        print(f"prefetcher started for {len(self.feeds)} feeds")
+        self._thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"prefetch poll failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _poll_feeds(self):
+        # collect articles from all feeds, feeds which did not change are skipped
+        feeds = list(self.feeds)
+        polled = [] # in config order, first feeds get the budget first
+        while feeds:
+            feed_url = feeds.pop(0)
+            if feed_url in polled:
+                continue
+            polled.append(feed_url)
+            try:
+                body, validators = conditional_fetch(feed_url, self.feed_validators.get(feed_url))
+            except Exception as e:
+                print(f"failed to fetch feed {feed_url}: {e}")
+                body = None # keep what we know about this feed until it works again
+            if body is None:
+                feeds.extend(self.child_feeds.get(feed_url, []))
+                continue
+            try:
+                articles, child_feeds = parse_feed(body, feed_url)
+            except ET.ParseError as e:
+                print(f"failed to parse feed {feed_url}: {e}")
+                feeds.extend(self.child_feeds.get(feed_url, []))
+                continue
+            # validators are saved only after parsing, so a broken feed is retried next round
+            self.feed_validators[feed_url] = validators
+            # sitemaps can list the whole archive (often oldest first), only the newest few are prefetched
+            self.feed_articles[feed_url] = dict(newest_first(articles)[:self.max_articles])
+            self.child_feeds[feed_url] = child_feeds
+            feeds.extend(child_feeds)
+
+        # sitemaps which were removed from their index are forgotten
+        for state in (self.feed_validators, self.feed_articles, self.child_feeds):
+            for feed_url in [feed_url for feed_url in state if feed_url not in polled]:
+                del state[feed_url]
+
+        pending = {}
+        for feed_url in polled:
+            pending.update(self.feed_articles.get(feed_url, {}))
+        return pending
+
+    def _missing_audio(self, url):
+        return [(language, output_type) for language in self.languages for output_type in self.types
+                if not has_cached_audio(url, language, output_type)]
+
+    # one polling round, returns list of article urls whose audio was (re)generated
+    # articles which do not fit in the budget are left for the next round
+    def poll_once(self):
+        started = time.monotonic()
+        self.llm_calls = 0
+        done = []
+        out_of_llm_budget = False
+
+        # order of work : never seen articles, articles whose feed version changed (both newest first),
+        # known articles whose audio was dropped from cache (tts only), then a few articles without version
+        pending = self._poll_feeds()
+
+        # forget articles which left every feed, their saved llm output would only use memory
+        for state in (self.articles, self.failures):
+            for url in [url for url in state if url not in pending]:
+                del state[url]
+
+        new, changed, rewarm, revalidate = [], [], [], []
+        for url, version in pending.items():
+            failure = self.failures.get(url)
+            if failure and failure["retry_at"] > started:
+                continue
+            state = self.articles.get(url)
+            if state is None:
+                new.append((url, version))
+            elif version and version != state["version"]:
+                changed.append((url, version))
+            elif self._missing_audio(url):
+                rewarm.append((url, version))
+            elif not version:
+                revalidate.append((url, version))
+
+        # when all prefetched audio is bigger than the cache, rewarming one article only evicts another one
+        # (and /generate entries) and the next poll rewarms that, so dont rewarm at all then
+        if rewarm:
+            prefetched_bytes = sum(state.get("audio_bytes", 0) for state in self.articles.values())
+            if prefetched_bytes > AUDIO_CACHE_MAX_BYTES:
+                print("prefetched audio does not fit in the cache, evicted audio is not rewarmed")
+                rewarm = []
+            rewarm = rewarm[:self.max_rewarms]
+
+        new, changed = newest_first(new), newest_first(changed)
+
+        # articles without version need a conditional request every time, check only some of them per poll
+        # and continue from where the last poll stopped so all of them get their turn
+        if revalidate:
+            start = self._revalidate_from % len(revalidate)
+            revalidate = (revalidate[start:] + revalidate[:start])[:self.max_revalidations]
+            self._revalidate_from = start + len(revalidate)
+
+        work = [(url, version, False) for url, version in new + changed] + \
+               [(url, version, True) for url, version in rewarm] + \
+               [(url, version, False) for url, version in revalidate]
+
+        for url, version, tts_only in work:
+            if self._stop.is_set():
+                break
+            if time.monotonic() - started > self.max_seconds:
+                print("prefetch time budget used, rest will be done in next poll")
+                break
+            # one llm call per language for each article
+            if not tts_only and self.llm_calls + len(self.languages) > self.max_llm_calls:
+                out_of_llm_budget = True
+                continue # no llm budget left, only tts rewarm can still run
+
+            try:
+                generated = self.rewarm_article(url) if tts_only else self.prefetch_article(url, version)
+            except Exception as e:
+                print(f"prefetch failed for {url}: {e}")
+                count = self.failures.get(url, {}).get("count", 0) + 1
+                # wait 1, 2, 4 ... polls (max 32) before trying this article again
+                self.failures[url] = {"count": count, "retry_at": time.monotonic() + self.interval * 2 ** min(count - 1, 5)}
+                continue
+            self.failures.pop(url, None)
+            if generated:
+                done.append(url)
+
+        if out_of_llm_budget:
+            print("prefetch llm budget used, rest will be done in next poll")
+        return done
+
+    def _make_audio(self, processed, language, output_type):
+        text_for_audio = processed["summary"] if output_type == "summary" else processed["cleaned_text"]
+        return generate_audio_bytes(text_for_audio, language).getvalue()
+
+    # run the pipeline for one article in all configured languages and types, returns True if audio was generated
+    def prefetch_article(self, url, version=None):
+        state = self.articles.get(url, {})
+
+        body, validators = conditional_fetch(url, state.get("validators"))
+        if body is None: # page not modified
+            self.articles[url] = {**state, "version": version}
+            return False
+
+        content = extract_article_content(url, html=body) # raw bytes, extractors find the charset
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if content_hash == state.get("hash"): # page changed but article text is same (ads, etc)
+            self.articles[url] = {**state, "version": version, "validators": validators}
+            return False
+
+        processed_by_language = {}
+        for language in self.languages:
+            processed = preprocess_with_llm(content, language)
+            self.llm_calls += 1
+            if processed.get("llm_failed"):
+                # dont cache untranslated audio, article is tried again later
+                raise Exception(f"llm failed for language {language}")
+            processed_by_language[language] = processed
+
+        # audio and state are updated only when every language and type worked,
+        # otherwise cache would have new audio for some languages and old for others
+        audio = {}
+        for language, processed in processed_by_language.items():
+            for output_type in self.types:
+                audio[(language, output_type)] = self._make_audio(processed, language, output_type)
+        for (language, output_type), audio_bytes in audio.items():
+            cache_audio(url, language, output_type, audio_bytes, expires=False)
+
+        self.articles[url] = {"version": version, "validators": validators, "hash": content_hash,
+                              "processed": processed_by_language,
+                              "audio_bytes": sum(len(audio_bytes) for audio_bytes in audio.values())}
+        print(f"prefetched {url}")
+        return True
+
+    # audio of an unchanged article was dropped from cache, make it again from the saved llm output (no llm call)
+    def rewarm_article(self, url):
+        processed_by_language = self.articles[url]["processed"]
+        for language, output_type in self._missing_audio(url):
+            audio_bytes = self._make_audio(processed_by_language[language], language, output_type)
+            cache_audio(url, language, output_type, audio_bytes, expires=False)
+        print(f"rewarmed {url}")
+        return True
+
+
+if __name__ == "__main__":
+    import sys
+
+    # run one polling round against a feed, eg. a feed in a local folder:
+    # python prefetch.py ./feeds/rss.xml
+    feeds = sys.argv[1:] or load_prefetch_config()["feeds"]
+    if not feeds:
+        print("usage: python prefetch.py <feed url or path> ...")
+        sys.exit(1)
+
+    prefetcher = Prefetcher(feeds, languages=["en"], types=["full", "summary"])
+    done = prefetcher.poll_once()
+    print(f"prefetched {len(done)} articles: {done}")
+
+    # second round should find nothing new
+    print(f"second round prefetched: {prefetcher.poll_once()}")
@@ -0,0 +1,371 @@
+# tests for the feed prefetcher, feeds and articles are files in a temp folder
+# llm and gTTS are replaced by fakes so no ollama or internet is needed
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+import backend
+import prefetch
+from prefetch import Prefetcher, conditional_fetch, parse_feed
+
+
+ARTICLE_TEXT = "This is a long test article about prefetching audio for feeds. " * 10
+
+
+def write_article(folder, name, text=ARTICLE_TEXT):
+    path = folder / name
+    path.write_text(f"<html><head><title>{name}</title></head><body><article><h1>{name}</h1>"
+                    f"<p>{text}</p><p>{text}</p></article></body></html>")
+    return path
+
+
+def touch(path):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+@pytest.fixture(autouse=True)
+def fake_pipeline(monkeypatch):
+    backend.clear_audio_cache()
+    calls = []
+
+    def fake_llm(text, language):
+        calls.append(language)
+        return {"cleaned_text": f"{language} full {text[:20]}", "summary": f"{language} summary"}
+
+    def fake_tts(text, language):
+        return BytesIO(f"mp3:{text}".encode())
+
+    monkeypatch.setattr(prefetch, "preprocess_with_llm", fake_llm)
+    monkeypatch.setattr(prefetch, "generate_audio_bytes", fake_tts)
+    yield calls
+    backend.clear_audio_cache()
+
+
+@pytest.fixture
+def sitemap(tmp_path):
+    for name in ["a.html", "b.html", "c.html"]:
+        write_article(tmp_path, name)
+    path = tmp_path / "sitemap.xml"
+    path.write_text('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                    '<url><loc>a.html</loc></url><url><loc>b.html</loc></url><url><loc>c.html</loc></url>'
+                    '</urlset>')
+    return path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def served(tmp_path):
+    # serves the temp folder over http, like a publisher would
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(tmp_path)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def article_url(folder, name):
+    return (folder / name).resolve().as_uri()
+
+
+def test_newest_first():
+    articles = [("old", "2023-01-01"), ("none", None), ("new", "Mon, 01 Jan 2024 10:00:00 GMT"),
+                ("mid", "2023-06-01T10:00:00Z"), ("bad", "yesterday")]
+
+    assert [url for url, _ in prefetch.newest_first(articles)] == ["new", "mid", "old", "none", "bad"]
+
+
+def test_parse_rss(tmp_path):
+    feed_url = (tmp_path / "rss.xml").as_uri()
+    body = b"""<rss><channel>
+        <item><link>a.html</link><pubDate>Mon, 01 Jan 2024 00:00:00 GMT</pubDate></item>
+        <item><guid>https://example.com/b</guid></item>
+        <item><guid isPermaLink="false">urn:uuid:123</guid></item>
+        <item><guid>not-a-url-123</guid></item>
+    </channel></rss>"""
+
+    articles, child_feeds = parse_feed(body, feed_url)
+
+    assert articles == [
+        (article_url(tmp_path, "a.html"), "Mon, 01 Jan 2024 00:00:00 GMT"),
+        ("https://example.com/b", None),
+    ]
+    assert child_feeds == []
+
+
+def test_remote_feed_cannot_point_to_local_files():
+    body = b"""<rss><channel>
+        <item><link>file:///tmp/leak/secret.html</link></item>
+        <item><guid>file:///tmp/leak/secret.html</guid></item>
+        <item><link>/posts/a</link></item>
+    </channel></rss>"""
+
+    articles, _ = parse_feed(body, "https://example.com/rss.xml")
+
+    assert articles == [("https://example.com/posts/a", None)]
+
+    index = b"<sitemapindex><sitemap><loc>file:///etc/sitemap.xml</loc></sitemap></sitemapindex>"
+    assert parse_feed(index, "https://example.com/index.xml") == ([], [])
+
+
+def test_parse_atom(tmp_path):
+    body = b"""<feed xmlns="http://www.w3.org/2005/Atom">
+        <entry><link rel="self" href="self.xml"/><link href="https://example.com/a"/><updated>2024-01-01</updated></entry>
+    </feed>"""
+
+    articles, _ = parse_feed(body, (tmp_path / "atom.xml").as_uri())
+
+    assert articles == [("https://example.com/a", "2024-01-01")]
+
+
+def test_parse_sitemap_index(tmp_path):
+    body = b"""<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+        <sitemap><loc>posts.xml</loc></sitemap>
+    </sitemapindex>"""
+
+    articles, child_feeds = parse_feed(body, (tmp_path / "index.xml").as_uri())
+
+    assert articles == []
+    assert child_feeds == [article_url(tmp_path, "posts.xml")]
+
+
+def test_conditional_fetch_local_file(tmp_path):
+    path = write_article(tmp_path, "a.html")
+
+    body, validators = conditional_fetch(path.as_uri())
+    assert body == path.read_bytes()
+
+    assert conditional_fetch(path.as_uri(), validators)[0] is None
+
+    touch(path)
+    assert conditional_fetch(path.as_uri(), validators)[0] == path.read_bytes()
+
+
+def test_poll_fills_cache_then_is_noop(sitemap, fake_pipeline):
+    folder = sitemap.parent
+    prefetcher = Prefetcher([str(sitemap)], languages=["en", "hi"], max_llm_calls=100)
+
+    done = prefetcher.poll_once()
+
+    assert done == [article_url(folder, name) for name in ["a.html", "b.html", "c.html"]]
+    for url in done:
+        for language in ["en", "hi"]:
+            assert backend.get_cached_audio(url, language, "full").startswith(f"mp3:{language} full".encode())
+            assert backend.get_cached_audio(url, language, "summary") == f"mp3:{language} summary".encode()
+    assert len(fake_pipeline) == 6
+
+    assert prefetcher.poll_once() == []
+    assert len(fake_pipeline) == 6
+
+
+def test_changed_article_is_refetched(sitemap, fake_pipeline):
+    folder = sitemap.parent
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=100)
+    prefetcher.poll_once()
+
+    # touched but same text : fetched again but no llm call
+    touch(folder / "a.html")
+    assert prefetcher.poll_once() == []
+    assert len(fake_pipeline) == 3
+
+    write_article(folder, "b.html", "Completely new text for the second article, it has changed. " * 10)
+    touch(folder / "b.html")
+    assert prefetcher.poll_once() == [article_url(folder, "b.html")]
+    assert len(fake_pipeline) == 4
+
+
+def test_new_rss_item_is_picked_up(tmp_path, fake_pipeline):
+    write_article(tmp_path, "a.html")
+    write_article(tmp_path, "b.html")
+    rss = tmp_path / "rss.xml"
+    rss.write_text("<rss><channel><item><link>a.html</link><pubDate>1</pubDate></item></channel></rss>")
+    prefetcher = Prefetcher([str(rss)])
+    assert prefetcher.poll_once() == [article_url(tmp_path, "a.html")]
+
+    rss.write_text("<rss><channel><item><link>b.html</link><pubDate>2</pubDate></item>"
+                   "<item><link>a.html</link><pubDate>1</pubDate></item></channel></rss>")
+    touch(rss)
+
+    assert prefetcher.poll_once() == [article_url(tmp_path, "b.html")]
+    assert len(fake_pipeline) == 2
+
+
+def test_newest_articles_first_and_limited_per_feed(tmp_path, fake_pipeline):
+    for name in ["a.html", "b.html", "c.html"]:
+        write_article(tmp_path, name)
+    # archive order : oldest first
+    sitemap = tmp_path / "sitemap.xml"
+    sitemap.write_text("<urlset><url><loc>a.html</loc><lastmod>2022-01-01</lastmod></url>"
+                       "<url><loc>b.html</loc><lastmod>2023-01-01</lastmod></url>"
+                       "<url><loc>c.html</loc><lastmod>2024-01-01</lastmod></url></urlset>")
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=1, max_articles=2)
+
+    assert prefetcher.poll_once() == [article_url(tmp_path, "c.html")]
+    assert prefetcher.poll_once() == [article_url(tmp_path, "b.html")]
+    assert prefetcher.poll_once() == []
+    assert len(fake_pipeline) == 2
+
+
+def test_articles_which_left_the_feeds_are_forgotten(tmp_path):
+    write_article(tmp_path, "a.html")
+    write_article(tmp_path, "b.html")
+    (tmp_path / "c.html").write_text("too short")
+    rss = tmp_path / "rss.xml"
+    rss.write_text("<rss><channel><item><link>a.html</link></item><item><link>b.html</link></item>"
+                   "<item><link>c.html</link></item></channel></rss>")
+    prefetcher = Prefetcher([str(rss)])
+    prefetcher.poll_once()
+    assert set(prefetcher.articles) == {article_url(tmp_path, "a.html"), article_url(tmp_path, "b.html")}
+    assert set(prefetcher.failures) == {article_url(tmp_path, "c.html")}
+
+    rss.write_text("<rss><channel><item><link>b.html</link></item></channel></rss>")
+    touch(rss)
+    prefetcher.poll_once()
+
+    assert set(prefetcher.articles) == {article_url(tmp_path, "b.html")}
+    assert prefetcher.failures == {}
+
+
+def test_llm_budget(sitemap, fake_pipeline):
+    folder = sitemap.parent
+    prefetcher = Prefetcher([str(sitemap)], languages=["en", "hi"], max_llm_calls=4)
+
+    assert prefetcher.poll_once() == [article_url(folder, "a.html"), article_url(folder, "b.html")]
+    assert len(fake_pipeline) == 4
+
+    assert prefetcher.poll_once() == [article_url(folder, "c.html")]
+    assert len(fake_pipeline) == 6
+
+
+def test_llm_budget_smaller_than_languages_is_rejected(sitemap):
+    with pytest.raises(ValueError):
+        Prefetcher([str(sitemap)], languages=["en", "hi"], max_llm_calls=1)
+
+
+def test_failed_llm_is_not_cached_and_backs_off(sitemap, fake_pipeline, monkeypatch):
+    folder = sitemap.parent
+    monkeypatch.setattr(prefetch, "preprocess_with_llm", lambda text, language: fake_pipeline.append(language) or {
+        "cleaned_text": text, "summary": text, "llm_failed": True})
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=2, interval=300)
+
+    assert prefetcher.poll_once() == []
+    assert len(fake_pipeline) == 2 # failed calls still use the budget
+    assert backend.get_cached_audio(article_url(folder, "a.html"), "en", "full") is None
+    assert article_url(folder, "a.html") not in prefetcher.articles
+    assert prefetcher.failures[article_url(folder, "a.html")]["count"] == 1
+
+    # a and b wait, c was not tried yet
+    prefetcher.poll_once()
+    assert len(fake_pipeline) == 3
+
+
+def test_failed_language_keeps_old_audio_and_state(sitemap, fake_pipeline, monkeypatch):
+    folder = sitemap.parent
+    url = article_url(folder, "a.html")
+    prefetcher = Prefetcher([str(sitemap)], languages=["en", "hi"], max_llm_calls=100)
+    prefetcher.poll_once()
+    old_audio = backend.get_cached_audio(url, "en", "full")
+    old_state = prefetcher.articles[url]
+
+    def llm_failing_for_hindi(text, language):
+        fake_pipeline.append(language)
+        if language == "hi":
+            return {"cleaned_text": text, "summary": text, "llm_failed": True}
+        return {"cleaned_text": f"{language} full new", "summary": f"{language} summary new"}
+    monkeypatch.setattr(prefetch, "preprocess_with_llm", llm_failing_for_hindi)
+    write_article(folder, "a.html", "The first article was rewritten with new text. " * 10)
+    touch(folder / "a.html")
+
+    assert prefetcher.poll_once() == []
+    assert backend.get_cached_audio(url, "en", "full") == old_audio
+    assert prefetcher.articles[url] == old_state
+
+
+def test_evicted_audio_is_rewarmed_without_llm(sitemap, fake_pipeline):
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=100)
+    done = prefetcher.poll_once()
+
+    backend.clear_audio_cache()
+
+    assert prefetcher.poll_once() == done
+    assert len(fake_pipeline) == 3
+    assert backend.get_cached_audio(done[0], "en", "summary") == b"mp3:en summary"
+
+
+def test_rewarms_are_capped(sitemap, fake_pipeline):
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=100, max_rewarms=1)
+    done = prefetcher.poll_once()
+
+    backend.clear_audio_cache()
+
+    assert prefetcher.poll_once() == done[:1]
+    assert prefetcher.poll_once() == done[1:2]
+    assert len(fake_pipeline) == 3
+
+
+def test_no_rewarm_when_prefetched_audio_is_bigger_than_cache(sitemap, monkeypatch):
+    monkeypatch.setattr(backend, "AUDIO_CACHE_MAX_BYTES", 100)
+    monkeypatch.setattr(prefetch, "AUDIO_CACHE_MAX_BYTES", 100)
+    tts_calls = []
+
+    def counting_tts(text, language):
+        tts_calls.append(text)
+        return BytesIO(f"mp3:{text}".encode())
+    monkeypatch.setattr(prefetch, "generate_audio_bytes", counting_tts)
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=100)
+    prefetcher.poll_once()
+    assert len(tts_calls) == 6
+
+    # three articles of about 55 bytes each dont fit in 100 bytes, so polls must not keep making audio
+    assert prefetcher.poll_once() == []
+    assert prefetcher.poll_once() == []
+    assert len(tts_calls) == 6
+
+
+def test_revalidations_are_capped_and_take_turns(sitemap, fake_pipeline):
+    folder = sitemap.parent
+    prefetcher = Prefetcher([str(sitemap)], max_llm_calls=100, max_revalidations=1)
+    prefetcher.poll_once()
+
+    for name in ["a.html", "b.html"]:
+        write_article(folder, name, f"Changed text of {name} for the revalidation test. " * 10)
+        touch(folder / name)
+
+    assert prefetcher.poll_once() == [article_url(folder, "a.html")]
+    assert prefetcher.poll_once() == [article_url(folder, "b.html")]
+
+
+def test_generate_is_cache_hit_after_prefetch(sitemap, served, monkeypatch):
+    prefetcher = Prefetcher([served + "sitemap.xml"], max_llm_calls=100)
+    url = prefetcher.poll_once()[0]
+    assert url == served + "a.html"
+    assert prefetcher.poll_once() == [] # http server answers 304
+
+    def no_extraction(url):
+        raise AssertionError("should be served from cache")
+    monkeypatch.setattr(api, "extract_article_content", no_extraction)
+
+    response = TestClient(api.app).post("/generate", json={"url": url, "language": "en", "type": "summary"})
+
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.content == b"mp3:en summary"
+
+
+def test_generate_refuses_non_http_urls():
+    url = "file:///tmp/leak/secret.html"
+    backend.cache_audio(url, "en", "full", b"secret")
+
+    response = TestClient(api.app).post("/generate", json={"url": url, "language": "en", "type": "full"})
+
+    assert response.status_code == 400